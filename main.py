@@ -2,10 +2,20 @@
 import os
 import asyncio
 import datetime
+import math
+import time
+import functools
+import random
+from collections import namedtuple
 from zoneinfo import ZoneInfo
-import requests
+import aiohttp
+import orjson
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from io import BytesIO
 from telegram import Bot
 from fastapi import FastAPI
@@ -18,6 +28,8 @@ TOKEN = os.getenv("TOKEN")
 CHAT_ID = int(os.getenv("CHAT_ID"))
 NEWS_API_KEY = os.getenv("NEWS_API_KEY")
 GNEWS_API_KEY = os.getenv("GNEWS_API_KEY")
+HAS_NEWSAPI = bool(NEWS_API_KEY)
+HAS_GNEWS = bool(GNEWS_API_KEY)
 
 bot = Bot(token=TOKEN)
 app = FastAPI()
@@ -25,41 +37,162 @@ TZ = ZoneInfo("America/Bogota")
 
 COINBASE_SYMBOL = {"bitcoin": "BTC", "ethereum": "ETH", "ripple": "XRP"}
 COINGECKO_ID = {"bitcoin": "bitcoin", "ethereum": "ethereum", "ripple": "ripple"}
+
 SEND_ORDERBOOK_FALLBACK_ZERO = (0.0, 0.0, 0.0, 0.0)
 
+HTTP_RETRIES = 3
+MAX_BACKOFF = 30  # segundos
+# Justo por debajo del intervalo horario: como mucho una petición por clave y por hora.
+# Absorbe llamadas repetidas dentro del mismo tick (reintentos, ticks solapados) y caduca
+# antes del siguiente tick para que cada análisis horario use datos frescos.
+CACHE_TTL = 3500  # segundos
+INDICATOR_WINDOW = 200  # puntos usados para SMA20/RSI14 y la gráfica; suficiente para estabilizar Wilder(14)
+NEWS_CHANGE_THRESHOLD = 3.0  # % de variación en 24h para adjuntar noticias
+NO_NEWS_TXT = "📰 No hay noticias relevantes disponibles."
+
+COINBASE_API = "https://api.exchange.coinbase.com"
+COINGECKO_API = "https://api.coingecko.com/api/v3"
+
+# coin_id -> símbolo, id CoinGecko, producto Coinbase y URLs, calculado una sola vez
+CoinMeta = namedtuple("CoinMeta", ["symbol", "cg_id", "product", "book_url", "cg_history_url"])
+
+def _make_meta(symbol, cg_id):
+    symbol = symbol.upper()
+    product = f"{symbol}-USD"
+    return CoinMeta(symbol, cg_id, product,
+                    f"{COINBASE_API}/products/{product}/book?level=1",
+                    f"{COINGECKO_API}/coins/{cg_id}/market_chart")
+
+COIN_META = {cid: _make_meta(sym, COINGECKO_ID[cid]) for cid, sym in COINBASE_SYMBOL.items()}
+
+def coin_meta(coin_id):
+    meta = COIN_META.get(coin_id)
+    if meta is None:
+        meta = _make_meta(coin_id, coin_id)
+    return meta
+
+# Sesión HTTP compartida (se crea en startup, se cierra en shutdown)
+aiohttp_session: aiohttp.ClientSession = None
+
 # ============================
 # UTIL
 # ============================
-def safe_json(resp):
+class TTLCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if time.monotonic() >= expires:
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+# Cachea el resultado de una corrutina por sus argumentos durante `ttl` segundos
+# `copy` se aplica a cada valor devuelto para que el llamador no pueda mutar la entrada cacheada
+def ttl_cached(ttl=CACHE_TTL, should_cache=lambda result: True, copy=None):
+    def decorator(func):
+        cache = TTLCache(ttl)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            value = cache.get(key)
+            if value is None:
+                value = await func(*args, **kwargs)
+                if should_cache(value):
+                    cache.set(key, value)
+            return copy(value) if copy else value
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+# Peticiones en curso: llamadas concurrentes con la misma clave comparten un solo Future
+_inflight = {}
+
+def single_flight(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        fut = _inflight.get(key)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        _inflight[key] = fut
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # evita "exception was never retrieved" si nadie más espera
+            raise
+        else:
+            fut.set_result(result)
+            return result
+        finally:
+            _inflight.pop(key, None)
+    return wrapper
+
+async def _json(resp):
     try:
-        return resp.json()
+        return orjson.loads(await resp.read())
     except Exception:
         return {}
 
-def get_coinbase_price(coin_id):
-    symbol = COINBASE_SYMBOL.get(coin_id, coin_id).upper()
-    url = f"https://api.exchange.coinbase.com/products/{symbol}-USD/ticker"
-    try:
-        r = requests.get(url, timeout=8)
-        data = safe_json(r)
-        if "price" in data:
-            return float(data["price"])
-    except Exception:
-        pass
+def _retry_delay(resp, attempt):
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_BACKOFF)
+        except ValueError:
+            pass
+    return min(2 ** attempt + random.random(), MAX_BACKOFF)
+
+# GET con reintentos (backoff exponencial + jitter) ante 429/5xx y errores de red
+async def _get_json(url, *, params=None, retries=HTTP_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            async with aiohttp_session.get(url, params=params) as resp:
+                if resp.status != 429 and resp.status < 500:
+                    return await _json(resp)
+                if attempt == retries:
+                    return {}
+                delay = _retry_delay(resp, attempt)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == retries:
+                return {}
+            delay = _retry_delay(None, attempt)
+        await asyncio.sleep(delay)
+    return {}
+
+@single_flight
+async def get_coinbase_price(coin_id):
+    # Precio medio del libro nivel 1: comparte la petición en curso con get_coinbase_orderbook
+    meta = coin_meta(coin_id)
+    bid_price, _, ask_price, _ = await get_coinbase_orderbook(coin_id)
+    if bid_price and ask_price:
+        return (bid_price + ask_price) / 2
     # fallback CoinGecko
     try:
-        cg_id = COINGECKO_ID.get(coin_id, coin_id)
-        r2 = requests.get(f"https://api.coingecko.com/api/v3/simple/price?ids={cg_id}&vs_currencies=usd", timeout=8).json()
-        return float(r2[cg_id]["usd"])
+        data = await _get_json(f"{COINGECKO_API}/simple/price",
+                               params={"ids":meta.cg_id, "vs_currencies":"usd"})
+        return float(data[meta.cg_id]["usd"])
     except Exception:
         return None
 
-def get_coinbase_orderbook(coin_id):
-    symbol = COINBASE_SYMBOL.get(coin_id, coin_id).upper()
-    url = f"https://api.exchange.coinbase.com/products/{symbol}-USD/book?level=1"
+@single_flight
+async def get_coinbase_orderbook(coin_id):
     try:
-        r = requests.get(url, timeout=8)
-        data = safe_json(r)
+        data = await _get_json(coin_meta(coin_id).book_url)
         bid_price = float(data["bids"][0][0])
         bid_qty = float(data["bids"][0][1])
         ask_price = float(data["asks"][0][0])
@@ -68,76 +201,107 @@ def get_coinbase_orderbook(coin_id):
     except Exception:
         return SEND_ORDERBOOK_FALLBACK_ZERO
 
-def get_history_coingecko(coin_id, days=3):
-    cg_id = COINGECKO_ID.get(coin_id, coin_id)
+@ttl_cached(should_cache=lambda df: not df.empty, copy=pd.DataFrame.copy)
+@single_flight
+async def get_history_coingecko(coin_id, days=3):
     try:
-        r = requests.get(f"https://api.coingecko.com/api/v3/coins/{cg_id}/market_chart",
-                         params={"vs_currency":"usd", "days":str(days)}, timeout=10).json()
-        prices = r.get("prices", [])
-        df = pd.DataFrame(prices, columns=["timestamp","price"])
-        df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms")
-        df["price"] = df["price"].astype(float)
-        return df
+        r = await _get_json(coin_meta(coin_id).cg_history_url,
+                            params={"vs_currency":"usd", "days":str(days)})
+        arr = np.asarray(r.get("prices", []), dtype=np.float64).reshape(-1, 2)
+        ts = arr[:,0].astype("int64").view("datetime64[ms]")
+        return pd.DataFrame({"timestamp": ts, "price": arr[:,1]})
     except Exception:
         return pd.DataFrame(columns=["timestamp","price"])
 
+def calc_change_24h(df, price):
+    # Variación % respecto al punto más cercano a 24h antes de la última muestra
+    if df.empty or not price:
+        return None
+    ts = df["timestamp"].to_numpy(dtype="datetime64[ns]")
+    target = ts[-1] - np.timedelta64(24, "h")
+    idx = min(int(np.searchsorted(ts, target)), len(ts) - 1)
+    if idx > 0 and target - ts[idx-1] < ts[idx] - target:
+        idx -= 1
+    prev_price = float(df["price"].iat[idx])
+    if not prev_price:
+        return None
+    return (price - prev_price) / prev_price * 100
+
+def calc_sma(a, k):
+    # Media móvil simple en una sola pasada con suma acumulada
+    a = np.asarray(a, dtype=np.float64)
+    out = np.full(a.shape, np.nan)
+    if a.size < k:
+        return out
+    cs = np.cumsum(a)
+    out[k-1] = cs[k-1] / k
+    out[k:] = (cs[k:] - cs[:-k]) / k
+    return out
+
 def calc_rsi(series, period=14):
-    delta = series.diff()
-    up = delta.clip(lower=0)
-    down = -delta.clip(upper=0)
-    roll_up = up.rolling(period).mean()
-    roll_down = down.rolling(period).mean()
-    rs = roll_up / roll_down
-    return 100 - (100 / (1 + rs))
-
-def get_news_for_symbol(symbol, max_articles=3):
-    if NEWS_API_KEY:
+    # RSI de Wilder: media exponencial con alpha = 1/period
+    arr = series.to_numpy(dtype=np.float64)
+    if arr.size == 0:
+        return pd.Series(arr, index=series.index)
+    d = np.diff(arr, prepend=arr[0])
+    up = np.where(d > 0, d, 0.0)
+    down = np.where(d < 0, -d, 0.0)
+    roll_up = pd.Series(up).ewm(alpha=1/period, adjust=False).mean().to_numpy()
+    roll_down = pd.Series(down).ewm(alpha=1/period, adjust=False).mean().to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rsi = 100 - 100 / (1 + roll_up / roll_down)
+    return pd.Series(rsi, index=series.index)
+
+@ttl_cached(should_cache=lambda txt: txt != NO_NEWS_TXT)
+@single_flight
+async def get_news_for_symbol(symbol, max_articles=3):
+    if HAS_NEWSAPI:
         try:
-            r = requests.get("https://newsapi.org/v2/everything",
-                             params={"q":f"{symbol} OR crypto OR cryptocurrency OR blockchain",
-                                     "language":"en", "pageSize":max_articles, "sortBy":"publishedAt",
-                                     "apiKey":NEWS_API_KEY}, timeout=8).json()
+            r = await _get_json("https://newsapi.org/v2/everything",
+                                params={"q":f"{symbol} OR crypto OR cryptocurrency OR blockchain",
+                                        "language":"en", "pageSize":str(max_articles), "sortBy":"publishedAt",
+                                        "apiKey":NEWS_API_KEY})
             articles = r.get("articles", [])[:max_articles]
             return "📰 *Noticias relevantes:*\n" + "\n".join([f"• {a.get('title')} ({a.get('source',{}).get('name')})\n  {a.get('url')}" for a in articles]) if articles else ""
         except Exception:
             pass
-    if GNEWS_API_KEY:
+    if HAS_GNEWS:
         try:
-            r = requests.get("https://gnews.io/api/v4/search",
-                             params={"q":symbol,"lang":"en","max":max_articles,"token":GNEWS_API_KEY}, timeout=8).json()
+            r = await _get_json("https://gnews.io/api/v4/search",
+                                params={"q":symbol,"lang":"en","max":str(max_articles),"token":GNEWS_API_KEY})
             articles = r.get("articles", [])[:max_articles]
             return "📰 *Noticias relevantes:*\n" + "\n".join([f"• {a.get('title')} ({a.get('source',{}).get('name')})\n  {a.get('url')}" for a in articles]) if articles else ""
         except Exception:
             pass
-    return "📰 No hay noticias relevantes disponibles."
+    return NO_NEWS_TXT
 
 # ============================
 # Chart with SMA + RSI
 # ============================
 def create_chart_image(df, symbol_label):
     try:
-        plt.figure(figsize=(8,4))
-        plt.plot(df["timestamp"], df["price"], label="Precio", color="blue", linewidth=1.5)
+        fig = Figure(figsize=(8,4))
+        canvas = FigureCanvasAgg(fig)
+        ax1 = fig.subplots()
+        ax1.plot(df["timestamp"], df["price"], label="Precio", color="blue", linewidth=1.5)
         if "SMA20" in df.columns:
-            plt.plot(df["timestamp"], df["SMA20"], label="SMA20 (media 20 períodos)", color="orange", linewidth=1.2)
+            ax1.plot(df["timestamp"], df["SMA20"], label="SMA20 (media 20 períodos)", color="orange", linewidth=1.2)
         if "RSI14" in df.columns:
             # RSI subplot
-            ax1 = plt.gca()
             ax2 = ax1.twinx()
             ax2.plot(df["timestamp"], df["RSI14"], label="RSI14", color="green", linestyle="--", alpha=0.5)
             ax2.axhline(70, color="red", linestyle=":")  # sobrecompra
             ax2.axhline(30, color="purple", linestyle=":")  # sobreventa
             ax2.set_ylabel("RSI14")
-        plt.title(f"{symbol_label} - últimas 72h")
-        plt.xlabel("Hora")
-        plt.ylabel("USD")
-        plt.legend(loc="upper left")
-        plt.grid(alpha=0.3)
+        ax1.set_title(f"{symbol_label} - últimas 72h")
+        ax1.set_xlabel("Hora")
+        ax1.set_ylabel("USD")
+        ax1.legend(loc="upper left")
+        ax1.grid(alpha=0.3)
         buf = BytesIO()
-        plt.tight_layout()
-        plt.savefig(buf, format="png", bbox_inches="tight")
+        fig.tight_layout()
+        canvas.print_png(buf)
         buf.seek(0)
-        plt.close()
         return buf
     except Exception:
         return None
@@ -146,20 +310,43 @@ def create_chart_image(df, symbol_label):
 # ANALYSIS
 # ============================
 async def analyze_coin(coin_id):
-    label = COINBASE_SYMBOL.get(coin_id, coin_id).upper()
+    label = coin_meta(coin_id).symbol
     now = datetime.datetime.now(TZ)
     timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
     try:
-        price = get_coinbase_price(coin_id)
-        bid_price, bid_qty, ask_price, ask_qty = get_coinbase_orderbook(coin_id)
-        df = get_history_coingecko(coin_id, days=3)
+        price, book, df = await asyncio.gather(
+            get_coinbase_price(coin_id),
+            get_coinbase_orderbook(coin_id),
+            get_history_coingecko(coin_id, days=3),
+            return_exceptions=True,
+        )
+        if isinstance(price, Exception):
+            price = None
+        if isinstance(book, Exception):
+            book = SEND_ORDERBOOK_FALLBACK_ZERO
+        if isinstance(df, Exception):
+            df = pd.DataFrame(columns=["timestamp","price"])
+        bid_price, bid_qty, ask_price, ask_qty = book
+
+        # Noticias solo si el mercado se movió lo suficiente (ahorra cuota de NewsAPI/GNews)
+        change_pct = calc_change_24h(df, price)
+        news_txt = ""
+        if change_pct is None or abs(change_pct) >= NEWS_CHANGE_THRESHOLD:
+            news_txt = NO_NEWS_TXT
+            if HAS_NEWSAPI or HAS_GNEWS:
+                try:
+                    news_txt = await get_news_for_symbol(label)
+                except Exception:
+                    pass
 
         if not df.empty:
-            df["SMA20"] = df["price"].rolling(20).mean()
-            df["RSI14"] = calc_rsi(df["price"], 14)
-            sma_val = df["SMA20"].iloc[-1]
-            rsi_val = df["RSI14"].iloc[-1]
+            # Indicadores solo sobre la ventana graficada
+            chart_df = df.iloc[-INDICATOR_WINDOW:].copy()
+            chart_df["SMA20"] = calc_sma(chart_df["price"].to_numpy(), 20)
+            chart_df["RSI14"] = calc_rsi(chart_df["price"], 14)
+            sma_val = float(chart_df["SMA20"].iat[-1])
+            rsi_val = float(chart_df["RSI14"].iat[-1])
 
             min24 = df["price"].min()
             max24 = df["price"].max()
@@ -167,22 +354,24 @@ async def analyze_coin(coin_id):
             sell_price = round(max24 * 0.98, 2)
 
             trend = "Neutra"
-            if price > sma_val:
-                trend = "Alcista"
-            elif price < sma_val:
-                trend = "Bajista"
+            if price and not math.isnan(sma_val):
+                if price > sma_val:
+                    trend = "Alcista"
+                elif price < sma_val:
+                    trend = "Bajista"
 
             rsi_status = "Neutral"
-            if rsi_val < 30:
-                rsi_status = "Sobreventa"
-            elif rsi_val > 70:
-                rsi_status = "Sobrecompra"
+            if not math.isnan(rsi_val):
+                if rsi_val < 30:
+                    rsi_status = "Sobreventa"
+                elif rsi_val > 70:
+                    rsi_status = "Sobrecompra"
 
         else:
+            chart_df = df
             sma_val, rsi_val, buy_price, sell_price, trend, rsi_status = None, None, None, None, "N/D", "N/D"
 
-        chart_buf = create_chart_image(df, label)
-        news_txt = get_news_for_symbol(label)
+        chart_buf = await asyncio.to_thread(create_chart_image, chart_df, label)
 
         lines = [
             f"📊 *ANÁLISIS EDUCATIVO — {label}*",
@@ -200,13 +389,13 @@ async def analyze_coin(coin_id):
             "_Este análisis es educativo, no es asesoramiento financiero._"
         ]
 
-        message = "\n".join([l for l in lines if l])
+        message = "\n".join(filter(None, lines))
 
-        bot.send_message(chat_id=CHAT_ID, text=message, parse_mode="Markdown")
+        await bot.send_message(chat_id=CHAT_ID, text=message, parse_mode="Markdown")
         if chart_buf:
-            bot.send_photo(chat_id=CHAT_ID, photo=chart_buf)
+            await bot.send_photo(chat_id=CHAT_ID, photo=chart_buf)
         else:
-            bot.send_message(chat_id=CHAT_ID, text="(No chart available)")
+            await bot.send_message(chat_id=CHAT_ID, text="(No chart available)")
 
         print(f"✅ Enviado análisis de {label} a las {timestamp_str}")
     except Exception as e:
@@ -216,18 +405,32 @@ async def analyze_coin(coin_id):
 # LOOP
 # ============================
 async def loop_crypto():
+    # Inicializar el bot aquí (hace get_me) para que una caída de Telegram no tumbe el proceso web
+    while True:
+        try:
+            await bot.initialize()
+            break
+        except Exception as e:
+            print("❌ Error initializing bot, retrying in 60s", e)
+            await asyncio.sleep(60)
+
     try:
-        bot.send_message(chat_id=CHAT_ID, text="🤖 Crypto Bot iniciado (educativo). Enviaré análisis cada hora entre 06:00 y 21:30 hora Colombia.")
+        await bot.send_message(chat_id=CHAT_ID, text="🤖 Crypto Bot iniciado (educativo). Enviaré análisis cada hora entre 06:00 y 21:30 hora Colombia.")
     except Exception:
         pass
 
     while True:
         now = datetime.datetime.now(TZ)
         if 6 <= now.hour < 21 or (now.hour == 21 and now.minute <= 30):
-            for coin in ["bitcoin","ethereum","ripple"]:
-                await analyze_coin(coin)
+            coins = ("bitcoin","ethereum","ripple")
+            results = await asyncio.gather(*[analyze_coin(c) for c in coins], return_exceptions=True)
+            for coin, res in zip(coins, results):
+                if isinstance(res, Exception):
+                    print("❌ Error analyzing", coin, res)
         next_run = (now + datetime.timedelta(hours=1)).replace(minute=0, second=5, microsecond=0)
-        wait_seconds = max((next_run - now).total_seconds(), 60)
+        # Recalcular tras el análisis para descontar lo que tardó y no acumular deriva
+        now = datetime.datetime.now(TZ)
+        wait_seconds = max((next_run - now).total_seconds(), 0)
         await asyncio.sleep(wait_seconds)
 
 # ============================
@@ -239,8 +442,19 @@ def home():
 
 @app.on_event("startup")
 async def startup_event():
+    global aiohttp_session
+    aiohttp_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=8, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=8),
+    )
     asyncio.create_task(loop_crypto())
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await bot.shutdown()
+    if aiohttp_session is not None:
+        await aiohttp_session.close()
+
 # ============================
 # ENTRY POINT PARA RENDER
 # ============================
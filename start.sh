@@ -1,3 +1,3 @@
 #!/bin/bash
 pip install -r requirements.txt
-uvicorn main:app --host 0.0.0.0 --port 10000
+uvicorn main:app --host 0.0.0.0 --port 10000 --loop uvloop